@@ -1,20 +1,123 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Literal, Optional, Tuple
+import msgspec
+import orjson
 import sqlite3
-from datetime import datetime
-import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+import asyncio
+import queue
+import time
 
 DB_PATH = "sync_browser.db"
+READER_POOL_SIZE = 4
 
-db_lock = threading.Lock()
+# timestamp disimpan sebagai epoch milidetik (INTEGER); ISO 8601 hanya di batas API
+ISO_TO_MS = "CAST(ROUND((julianday({}) - 2440587.5) * 86400000) AS INTEGER)"
+MS_TO_ISO = "strftime('%Y-%m-%dT%H:%M:%fZ', {} / 1000.0, 'unixepoch')"
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+SQLITE_INT_MIN, SQLITE_INT_MAX = -(2**63), 2**63 - 1
+
+# kolom yang boleh diminta lewat ?fields= di /api/bookmarks
+BOOKMARK_FIELDS = {
+    "id": "b.id",
+    "browser_name": "br.name",
+    "device_name": "br.device_name",
+    "profile_name": "br.profile_name",
+    "title": "b.title",
+    "url": "b.url",
+    "folder_path": "b.folder_path",
+    "created_at": MS_TO_ISO.format("b.created_at"),
+    "updated_at": MS_TO_ISO.format("b.updated_at"),
+}
+
+_wal_enabled = False
 
 def get_conn():
+    global _wal_enabled
     conn = sqlite3.connect(DB_PATH, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    # journal_mode=WAL tersimpan di file DB, cukup diset sekali per proses;
+    # pragma di bawahnya berlaku per koneksi
+    if not _wal_enabled:
+        # page_size hanya berlaku untuk DB baru dan harus diset sebelum WAL aktif
+        conn.execute("PRAGMA page_size=8192")
+        conn.execute("PRAGMA journal_mode=WAL")
+        _wal_enabled = True
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")
+    conn.execute("PRAGMA mmap_size=268435456")
     return conn
 
+# koneksi dibuka sekali lalu dipakai ulang antar request
+class ConnectionPool:
+    def __init__(self, size: int):
+        self._conns = queue.Queue()
+        for _ in range(size):
+            self._conns.put(get_conn())
+
+    @contextmanager
+    def acquire(self):
+        # satu koneksi hanya dipegang satu thread dalam satu waktu
+        conn = self._conns.get()
+        try:
+            yield conn
+        finally:
+            self._conns.put(conn)
+
+    def close(self):
+        while not self._conns.empty():
+            conn = self._conns.get_nowait()
+            conn.execute("PRAGMA optimize")
+            conn.close()
+
+# diisi saat startup: satu koneksi writer + pool koneksi reader (WAL)
+writer_conn: Optional[sqlite3.Connection] = None
+reader_pool: Optional[ConnectionPool] = None
+# semua tulisan lewat satu thread ini, jadi writer_conn tidak perlu lock;
+# reader jalan paralel di threadpool berkat WAL
+writer_executor: Optional[ThreadPoolExecutor] = None
+
+# (name, device_name, profile_name) -> browsers.id; baris browser tidak pernah dihapus
+_browser_cache: dict = {}
+
+BOOKMARKS_TABLE = """
+    bookmarks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        browser_id INTEGER NOT NULL,
+        title TEXT,
+        url TEXT NOT NULL,
+        folder_path TEXT NOT NULL DEFAULT '',
+        created_at INTEGER,
+        updated_at INTEGER,
+        UNIQUE(browser_id, url, folder_path),
+        FOREIGN KEY (browser_id) REFERENCES browsers(id)
+    )
+"""
+
+def migrate_bookmarks_table(conn):
+    # DB lama: timestamp TEXT (ISO) dan folder_path boleh NULL.
+    # Kolom TEXT akan mengubah integer jadi teks lagi, jadi tabelnya harus dibangun ulang.
+    # Semua langkah dalam satu transaksi eksplisit: DDL di mode legacy sqlite3 tidak
+    # membuka transaksi sendiri, jadi tanpa BEGIN rename/create langsung ter-commit.
+    with conn:
+        conn.execute("BEGIN")
+        conn.execute("ALTER TABLE bookmarks RENAME TO bookmarks_old")
+        conn.execute("CREATE TABLE " + BOOKMARKS_TABLE)
+        conn.execute(
+            f"""
+            INSERT OR IGNORE INTO bookmarks (id, browser_id, title, url, folder_path, created_at, updated_at)
+            SELECT id, browser_id, title, url, COALESCE(folder_path, ''),
+                   {ISO_TO_MS.format("created_at")}, {ISO_TO_MS.format("updated_at")}
+            FROM bookmarks_old
+            """
+        )
+        conn.execute("DROP TABLE bookmarks_old")
+
 def init_db():
     with get_conn() as conn:
         cur = conn.cursor()
@@ -29,35 +132,37 @@ def init_db():
             )
             """
         )
+        cur.execute("CREATE TABLE IF NOT EXISTS " + BOOKMARKS_TABLE)
+        columns = {r["name"]: r["type"] for r in cur.execute("PRAGMA table_info(bookmarks)")}
+        if columns["updated_at"] != "INTEGER":
+            migrate_bookmarks_table(conn)
+        # urutan listing + keyset pagination: (updated_at, id) menurun
         cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS bookmarks (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                browser_id INTEGER NOT NULL,
-                title TEXT,
-                url TEXT NOT NULL,
-                folder_path TEXT,
-                created_at TEXT,
-                updated_at TEXT,
-                UNIQUE(browser_id, url, folder_path),
-                FOREIGN KEY (browser_id) REFERENCES browsers(id)
-            )
-            """
+            "CREATE INDEX IF NOT EXISTS idx_bm_updated_id ON bookmarks(updated_at DESC, id DESC)"
         )
         conn.commit()
+        # statistik awal buat query planner; selanjutnya dijaga PRAGMA optimize
+        cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")
+        if cur.fetchone() is None:
+            cur.execute("ANALYZE")
+    conn.close()
 
-class BookmarkIn(BaseModel):
-    title: Optional[str] = ""
+class BookmarkIn(msgspec.Struct):
     url: str
+    title: Optional[str] = ""
     folder_path: Optional[str] = ""
-    created_at: Optional[str] = None
+    # harus RFC 3339; nilai yang tidak valid ditolak (422), bukan disimpan sebagai NULL
+    created_at: Optional[datetime] = None
 
-class SyncBookmarksPayload(BaseModel):
+class SyncBookmarksPayload(msgspec.Struct):
     browser_name: str
     device_name: str
     profile_name: str
     bookmarks: List[BookmarkIn]
 
+# decoder dibangun sekali saat import, bukan per request
+sync_payload_decoder = msgspec.json.Decoder(SyncBookmarksPayload)
+
 app = FastAPI(title="Local Browser Sync")
 
 # CORS biar bisa diakses dari extension
@@ -67,89 +172,111 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Total-Count"],
 )
 
 @app.on_event("startup")
 def on_startup():
+    global writer_conn, reader_pool, writer_executor
     init_db()
+    writer_conn = get_conn()
+    reader_pool = ConnectionPool(READER_POOL_SIZE)
+    writer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+
+@app.on_event("shutdown")
+def on_shutdown():
+    writer_executor.shutdown(wait=True)
+    reader_pool.close()
+    writer_conn.execute("PRAGMA optimize")
+    writer_conn.close()
 
 def get_or_create_browser_id(name: str, device_name: str, profile_name: str) -> int:
-    with db_lock:
-        conn = get_conn()
-        cur = conn.cursor()
-        cur.execute(
-            """
-            SELECT id FROM browsers 
-            WHERE name = ? AND device_name = ? AND profile_name = ?
-            """,
-            (name, device_name, profile_name),
-        )
-        row = cur.fetchone()
-        if row:
-            return row["id"]
-        cur.execute(
+    key = (name, device_name, profile_name)
+    browser_id = _browser_cache.get(key)
+    if browser_id is not None:
+        return browser_id
+    with writer_conn:
+        # satu statement: insert kalau belum ada, selalu kembalikan id-nya
+        cur = writer_conn.execute(
             """
             INSERT INTO browsers (name, device_name, profile_name)
             VALUES (?, ?, ?)
+            ON CONFLICT (name, device_name, profile_name) DO UPDATE SET name = excluded.name
+            RETURNING id
             """,
-            (name, device_name, profile_name),
+            key,
         )
-        conn.commit()
-        return cur.lastrowid
+        browser_id = cur.fetchone()[0]
+    # baru di-cache setelah commit berhasil
+    _browser_cache[key] = browser_id
+    return browser_id
 
 @app.post("/api/sync/bookmarks")
-def sync_bookmarks(payload: SyncBookmarksPayload):
+async def sync_bookmarks(request: Request):
+    # parse + validasi body sekaligus di msgspec (C), tanpa model Pydantic
+    try:
+        payload = sync_payload_decoder.decode(await request.body())
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(writer_executor, save_bookmarks, payload)
+
+def to_epoch_ms(dt: Optional[datetime]) -> Optional[int]:
+    if dt is None:
+        return None
+    if dt.tzinfo is None:
+        # tanpa zona waktu dianggap UTC, sama seperti data lama
+        dt = dt.replace(tzinfo=timezone.utc)
+    return (dt - EPOCH) // timedelta(milliseconds=1)
+
+# statement satu baris yang tetap, jadi cukup di-prepare sekali per koneksi
+BOOKMARK_UPSERT_SQL = """
+    INSERT INTO bookmarks (browser_id, title, url, folder_path, created_at, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (browser_id, url, folder_path) DO UPDATE SET
+        title = excluded.title,
+        created_at = COALESCE(excluded.created_at, bookmarks.created_at),
+        updated_at = excluded.updated_at
+"""
+
+# dijalankan di writer_executor
+def save_bookmarks(payload: SyncBookmarksPayload) -> dict:
     browser_id = get_or_create_browser_id(
         payload.browser_name,
         payload.device_name,
         payload.profile_name,
     )
 
-    now = datetime.utcnow().isoformat()
+    now = time.time_ns() // 1_000_000
 
-    with db_lock:
-        conn = get_conn()
-        cur = conn.cursor()
-        inserted = 0
-        updated = 0
-
-        for b in payload.bookmarks:
-            cur.execute(
-                """
-                SELECT id FROM bookmarks
-                WHERE browser_id = ? AND url = ? AND IFNULL(folder_path, '') = ?
-                """,
-                (browser_id, b.url, b.folder_path or ""),
-            )
-            row = cur.fetchone()
-            if row:
-                cur.execute(
-                    """
-                    UPDATE bookmarks
-                    SET title = ?, created_at = COALESCE(?, created_at), updated_at = ?
-                    WHERE id = ?
-                    """,
-                    (b.title, b.created_at, now, row["id"]),
-                )
-                updated += 1
-            else:
-                cur.execute(
-                    """
-                    INSERT INTO bookmarks (browser_id, title, url, folder_path, created_at, updated_at)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                    """,
-                    (
-                        browser_id,
-                        b.title,
-                        b.url,
-                        b.folder_path or "",
-                        b.created_at,
-                        now,
-                    ),
-                )
-                inserted += 1
+    # bookmark yang sama (url + folder) bisa muncul berkali-kali; title diambil dari
+    # yang terakhir, created_at dari yang terakhir tidak NULL (sama seperti COALESCE)
+    latest = {}
+    for b in payload.bookmarks:
+        key = (b.url, b.folder_path or "")
+        created_at = b.created_at
+        if created_at is None and key in latest:
+            created_at = latest[key][1]
+        latest[key] = (b.title, created_at)
+    rows = (
+        (browser_id, title, url, folder_path, to_epoch_ms(created_at), now)
+        for (url, folder_path), (title, created_at) in latest.items()
+    )
 
-        conn.commit()
+    with writer_conn:
+        cur = writer_conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute("SELECT COUNT(*) FROM bookmarks WHERE browser_id = ?", (browser_id,))
+        before = cur.fetchone()[0]
+
+        cur.executemany(BOOKMARK_UPSERT_SQL, rows)
+
+        cur.execute("SELECT COUNT(*) FROM bookmarks WHERE browser_id = ?", (browser_id,))
+        inserted = cur.fetchone()[0] - before
+        updated = len(latest) - inserted
+
+    # murah kalau tidak ada yang perlu di-ANALYZE ulang
+    writer_conn.execute("PRAGMA optimize")
 
     return {
         "status": "ok",
@@ -158,22 +285,92 @@ def sync_bookmarks(payload: SyncBookmarksPayload):
         "browser_id": browser_id,
     }
 
-@app.get("/api/bookmarks")
-def list_bookmarks():
-    with db_lock:
-        conn = get_conn()
+def load_bookmarks_page(
+    names: List[str], after: Optional[Tuple[int, int]], limit: int, columnar: bool
+) -> Tuple[bytes, Optional[str], Optional[int]]:
+    columns = ", ".join(f"{BOOKMARK_FIELDS[n]} AS {n}" for n in names)
+    select = f"""
+        SELECT {columns}, b.updated_at AS _cursor_ts, b.id AS _cursor_id
+        FROM bookmarks b
+        JOIN browsers br ON br.id = b.browser_id
+    """
+    if after is None:
+        sql = f"{select} ORDER BY b.updated_at DESC, b.id DESC LIMIT ?"
+        params = (limit,)
+    else:
+        # (updated_at, id) < (?, ?) hanya di-seek lewat updated_at, padahal satu sync
+        # memberi updated_at yang sama ke semua barisnya. Dipecah jadi dua seek yang
+        # masing-masing dibatasi limit, lalu digabung.
+        sql = f"""
+            SELECT * FROM (
+                {select}
+                WHERE b.updated_at = ? AND b.id < ?
+                ORDER BY b.id DESC LIMIT ?
+            )
+            UNION ALL
+            SELECT * FROM (
+                {select}
+                WHERE b.updated_at < ?
+                ORDER BY b.updated_at DESC, b.id DESC LIMIT ?
+            )
+            ORDER BY _cursor_ts DESC, _cursor_id DESC
+            LIMIT ?
+        """
+        params = (after[0], after[1], limit, after[0], limit, limit)
+
+    with reader_pool.acquire() as conn:
         cur = conn.cursor()
-        cur.execute(
-            """
-            SELECT b.id, br.name as browser_name, br.device_name, br.profile_name,
-                   b.title, b.url, b.folder_path, b.created_at, b.updated_at
-            FROM bookmarks b
-            JOIN browsers br ON br.id = b.browser_id
-            ORDER BY b.updated_at DESC
-            """
-        )
+        cur.row_factory = None
+        cur.execute(sql, params)
         rows = cur.fetchall()
-        return [dict(r) for r in rows]
+        # COUNT(*) men-scan seluruh index, jadi hanya di halaman pertama
+        total = None
+        if after is None:
+            total = cur.execute("SELECT COUNT(*) FROM bookmarks").fetchone()[0]
+
+    next_cursor = f"{rows[-1][-2]},{rows[-1][-1]}" if len(rows) == limit else None
+    # langsung ke orjson, lewati jsonable_encoder + json stdlib
+    if columnar:
+        # nama kolom sekali saja, tiap baris jadi array (tanpa dict per baris)
+        n = len(names)
+        data = {"columns": names, "rows": [r[:n] for r in rows]}
+    else:
+        data = [dict(zip(names, r)) for r in rows]
+    return orjson.dumps(data), next_cursor, total
+
+@app.get("/api/bookmarks")
+async def list_bookmarks(
+    fields: Optional[str] = None,
+    limit: int = Query(500, ge=1, le=5000),
+    cursor: Optional[str] = None,
+    shape: Literal["rows", "columns"] = "rows",
+):
+    names = [f.strip() for f in fields.split(",")] if fields else list(BOOKMARK_FIELDS)
+    unknown = [n for n in names if n not in BOOKMARK_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+
+    # keyset pagination: cursor = "<updated_at>,<id>" dari baris terakhir halaman sebelumnya
+    after = None
+    if cursor:
+        try:
+            cursor_ts, cursor_id = cursor.split(",")
+            after = (int(cursor_ts), int(cursor_id))
+            # di luar INTEGER 64-bit SQLite tidak bisa di-bind (OverflowError -> 500)
+            if not all(SQLITE_INT_MIN <= v <= SQLITE_INT_MAX for v in after):
+                raise ValueError(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    body, next_cursor, total = await asyncio.to_thread(
+        load_bookmarks_page, names, after, limit, shape == "columns"
+    )
+    headers = {}
+    if total is not None:
+        headers["X-Total-Count"] = str(total)
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+    return Response(body, media_type="application/json", headers=headers)
 
 if __name__ == "__main__":
     import uvicorn